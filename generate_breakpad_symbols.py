@@ -7,77 +7,331 @@
 Currently, the tool only supports Linux and Android. Support for other
 platforms is planned.
 
+If pyelftools is installed it is used to read the ELF metadata of the binaries,
+otherwise readelf is used.
+
 This is a modified version of:
 https://chromium.googlesource.com/chromium/src/+/master/components/crash/content/tools/generate_breakpad_symbols.py
 """
 import argparse
+from collections import deque
+import functools
+import json
+import multiprocessing
 import os
 import re
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+
+try:
+    from elftools.common.exceptions import ELFError
+    from elftools.elf.elffile import ELFFile
+except ImportError:
+    # pyelftools is optional, fall back to readelf.
+    ELFFile = None
+
+# Where distributions install separate debug info files.
+DEBUG_DIR = '/usr/lib/debug'
+
+# Matches a resolved dependency in the output of ldd.
+LDD_RE = re.compile(rb'^\t.* => (.+) \(.*\)$', re.MULTILINE)
+# Matches a dependency ldd couldn't resolve.
+LDD_NOT_FOUND_RE = re.compile(rb'^\t.* => not found$', re.MULTILINE)
+# Matches the 'binary:' header ldd prints before the dependencies of each
+# binary when given several.
+LDD_HEADER_RE = re.compile(rb'^(\S.*):$', re.MULTILINE)
+# Matches the first line of the dump_syms output.
+MODULE_RE = re.compile(rb'^MODULE [^ ]+ [^ ]+ ([0-9A-F]+) (.*)$', re.MULTILINE)
+# Match the soname, build-id and debuglink in the output of
+# readelf -d -n -p .gnu_debuglink.
+SONAME_RE = re.compile(rb'\(SONAME\)\s*Library soname: \[([^\]]+)\]')
+BUILD_ID_RE = re.compile(rb'Build ID: ([0-9a-f]+)')
+DEBUGLINK_RE = re.compile(rb"String dump of section '\.gnu_debuglink':\n\s*\[\s*0\]\s+([^\n]+)")
+
+# Where the ldd and ELF results of previous runs are stored, and the version
+# of their format.
+CACHE_FILE = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                          'breakpad-utils', 'cache.json')
+CACHE_VERSION = 3
+# The dynamic linker's cache of the library search path, which affects what
+# ldd resolves the dependencies to.
+LD_SO_CACHE = '/etc/ld.so.cache'
+
 
 def GetCommandOutput(command):
     """Runs the command list, returning its output.
     Prints the given command (which should be a list of one or more strings),
-    then runs it and returns its output (stdout) as a string.
+    then runs it and returns its output (stdout) as bytes, leaving it to the
+    caller to decode only what it needs.
     From chromium_utils.
     """
-    out = subprocess.run(command, capture_output = True, encoding = 'utf-8', check=False)
+    out = subprocess.run(command, capture_output = True, check=False)
     if out.returncode != 0:
-        print(f'{command[0]}: returncode: {out.returncode} stderr: {out.stderr}', file=sys.stderr)
+        stderr = out.stderr.decode('utf-8', errors='replace')
+        print(f'{command[0]}: returncode: {out.returncode} stderr: {stderr}', file=sys.stderr)
         return None
     return out.stdout
 
+@functools.lru_cache(maxsize=None)
+def IsExecutable(path):
+    """Cached os.access check, as the same rpaths are probed for many libraries."""
+    return os.access(path, os.X_OK)
+
 def FindLib(lib, rpaths):
     """Resolves the given library relative to a list of rpaths."""
     if lib.find('@rpath') == -1:
         return lib
     for rpath in rpaths:
         real_lib = re.sub('@rpath', rpath, lib)
-        if os.access(real_lib, os.X_OK):
+        if IsExecutable(real_lib):
             return real_lib
     print(f'Could not find "{lib}"')
     return None
 
-def GetSharedLibraryDependencies(binary):
-    """Return absolute paths to all shared library dependecies of the binary."""
-    ldd = GetCommandOutput(['ldd', binary])
-    lib_re = re.compile(r'^\t.* => (.+) \(.*\)$')
-    result = []
-    for line in ldd.splitlines():
-        m = lib_re.match(line)
-        if m:
-            result.append(m.group(1))
-    return result
-
-def GetDebugFile(binary):
-    """Get the ubuntu debug symbol file for a given binary"""
-    unstrip = GetCommandOutput(['eu-unstrip', '-n', '-e', binary]).rstrip().split(' ')
-    dbg_file = unstrip[3]
-    # it looks like '-' is supposed to be the value for 'no debug info exists', but
-    # libpthread.so returns '.' which exists but is wrong.
-    return dbg_file if dbg_file not in ('-','.') else None
-
-def GenerateSymbols(symbol_dir, binary):
-    """Dumps the symbols of binary and places them in the given directory."""
-    dump_cmd =['dump_syms', '-v', binary]
+def GetSharedLibraryDependencies(binaries):
+    """Return absolute paths to all shared library dependecies of each binary.
+    Returns a dict mapping each binary to its list of dependencies, and the set
+    of binaries that have dependencies ldd couldn't find. ldd is run once for
+    the whole list, printing a 'binary:' header before the dependencies of each
+    binary when given more than one.
+    """
+    result = {binary: [] for binary in binaries}
+    not_found = set()
+    ldd = GetCommandOutput(['ldd'] + binaries) if len(binaries) > 1 else None
+    if ldd is not None:
+        headers = [m for m in LDD_HEADER_RE.finditer(ldd) if os.fsdecode(m.group(1)) in result]
+        for header, next_header in zip(headers, headers[1:] + [None]):
+            binary = os.fsdecode(header.group(1))
+            end = next_header.start() if next_header is not None else len(ldd)
+            deps = LDD_RE.findall(ldd, header.end(), end)
+            result[binary] = [os.fsdecode(d) for d in deps]
+            if LDD_NOT_FOUND_RE.search(ldd, header.end(), end):
+                not_found.add(binary)
+        return result, not_found
+
+    # Either there is a single binary or the batch failed, e.g. because one of
+    # the binaries isn't dynamically linked. Fall back to one ldd per binary.
+    for binary in binaries:
+        ldd = GetCommandOutput(['ldd', binary])
+        if ldd is not None:
+            result[binary] = [os.fsdecode(d) for d in LDD_RE.findall(ldd)]
+            if LDD_NOT_FOUND_RE.search(ldd):
+                not_found.add(binary)
+    return result, not_found
+
+def GetBinaryMetaFromReadelf(binary):
+    """Reads the soname, build-id and debuglink of a binary with a single
+    readelf call, for when pyelftools isn't available.
+    """
+    readelf = GetCommandOutput(['readelf', '-W', '-d', '-n', '-p', '.gnu_debuglink', binary])
+    if readelf is None:
+        return (None, None, None)
+    m = SONAME_RE.search(readelf)
+    soname = m.group(1).decode('utf-8') if m else None
+    m = BUILD_ID_RE.search(readelf)
+    build_id = m.group(1).decode('utf-8') if m else None
+    m = DEBUGLINK_RE.search(readelf)
+    debuglink = os.fsdecode(m.group(1)) if m else None
+    return (soname, build_id, debuglink)
+
+# Results of GetBinaryMeta keyed by (st_dev, st_ino), so that the same file
+# reached through different paths is only parsed once.
+_binary_meta_cache = {}
+
+def GetBinaryMeta(binary):
+    """Returns the (soname, build_id, debuglink) tuple of a binary, any of which
+    may be None. build_id is a lowercase hex string and debuglink the file name
+    from the .gnu_debuglink section.
+    """
+    try:
+        st = os.stat(binary)
+        key = (st.st_dev, st.st_ino)
+    except OSError:
+        key = binary
+    if key not in _binary_meta_cache:
+        if ELFFile is not None:
+            _binary_meta_cache[key] = GetBinaryMetaFromElf(binary)
+        else:
+            _binary_meta_cache[key] = GetBinaryMetaFromReadelf(binary)
+    return _binary_meta_cache[key]
+
+def GetBinaryMetaFromElf(binary):
+    """Reads the soname, build-id and debuglink of a binary in a single pass
+    over its sections.
+    """
+    soname = None
+    build_id = None
+    debuglink = None
+    try:
+        with open(binary, 'rb') as f:
+            for section in ELFFile(f).iter_sections():
+                if section.name == '.dynamic':
+                    soname = next((tag.soname for tag in section.iter_tags()
+                                   if tag.entry.d_tag == 'DT_SONAME'), None)
+                elif section.name == '.note.gnu.build-id':
+                    for note in section.iter_notes():
+                        if note['n_type'] == 'NT_GNU_BUILD_ID':
+                            build_id = note['n_desc']
+                elif section.name == '.gnu_debuglink':
+                    debuglink = section.data().split(b'\0', 1)[0].decode('utf-8')
+    except (OSError, ELFError) as e:
+        print(f'{binary}: {e}', file=sys.stderr)
+        return (None, None, None)
+    return (soname, build_id, debuglink)
+
+def FindDebugFile(binary, build_id, debuglink):
+    """Looks up the debug symbol file for a binary from its build-id and
+    .gnu_debuglink, in the same places eu-unstrip does. Returns None if none
+    of them exist.
+    """
+    candidates = []
+    if build_id:
+        candidates.append(os.path.join(DEBUG_DIR, '.build-id', build_id[:2], build_id[2:] + '.debug'))
+    if debuglink:
+        binary_dir = os.path.dirname(os.path.realpath(binary))
+        candidates += [os.path.join(binary_dir, debuglink),
+                       os.path.join(binary_dir, '.debug', debuglink),
+                       os.path.join(DEBUG_DIR, binary_dir.lstrip('/'), debuglink)]
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+def GetModuleId(build_id):
+    """Returns the module id dump_syms derives from a build-id: the first 16
+    bytes formatted as a GUID, followed by an age of 0.
+    """
+    guid = bytes.fromhex(build_id)[:16].ljust(16, b'\0')
+    if sys.byteorder == 'little':
+        guid = guid[3::-1] + guid[5:3:-1] + guid[7:5:-1] + guid[8:]
+    return guid.hex().upper() + '0'
+
+def LoadCache(cache_file):
+    """Loads the results of previous runs, keyed by the real path of each binary.
+    The cache is discarded if it has a different format, or if LD_LIBRARY_PATH
+    or the dynamic linker's cache changed, as they affect what ldd resolves the
+    dependencies to.
+    """
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if (cache.get('version') != CACHE_VERSION or
+            cache.get('ld_library_path') != os.environ.get('LD_LIBRARY_PATH') or
+            cache.get('ld_so_cache') != GetFileStamp(LD_SO_CACHE)):
+        return {}
+    return cache.get('binaries', {})
+
+def SaveCache(cache_file, binaries):
+    """Writes the results of this run for use by the next one."""
+    cache = {'version': CACHE_VERSION, 'ld_library_path': os.environ.get('LD_LIBRARY_PATH'),
+             'ld_so_cache': GetFileStamp(LD_SO_CACHE), 'binaries': binaries}
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+    os.replace(tmp_file, cache_file)
+
+def GetFileStamp(path):
+    """Returns the [ino, ctime_ns, mtime_ns, size] of the file path points to,
+    or None if it doesn't exist. The inode and ctime catch files replaced with
+    one that has the same mtime and size, as package managers do by renaming.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_ctime_ns, st.st_mtime_ns, st.st_size]
+
+def GetCacheEntry(cache, binary):
+    """Returns the cache entry for binary, replacing it with an empty one if the
+    binary changed since it was stored. The dependencies are dropped from the
+    entry if any of them changed, e.g. because a library upgrade moved the
+    symlink ldd found it through.
+    """
+    stamp = GetFileStamp(binary)
+    entry = cache.get(binary)
+    if entry is None or entry['stamp'] != stamp:
+        entry = {'stamp': stamp}
+        cache[binary] = entry
+    elif 'deps' in entry and any(dep_stamp is None or GetFileStamp(dep) != dep_stamp
+                                 for dep, dep_stamp in entry['deps']):
+        del entry['deps']
+    return entry
+
+def GenerateSymbols(symbol_dir, binary, meta=None):
+    """Dumps the symbols of binary and places them in the given directory.
+    meta is the (soname, build_id, debuglink) tuple from a previous
+    GetBinaryMeta call, if known. Returns the log lines for the binary, so that
+    the caller can print them without interleaving output from other workers,
+    and the meta tuple.
+    """
+    log = [f'binary: {binary}']
+    dump_cmd =['dump_syms', binary]
+
+    if meta is None:
+        meta = GetBinaryMeta(binary)
+    soname, build_id, debuglink = meta
+    if soname is not None:
+        log.append(f'soname: {soname}')
+
+    # The symbols only depend on the build-id, so there is nothing to do if they
+    # were already dumped. dump_syms names the module after the soname, older
+    # versions use the file name.
+    if build_id is not None:
+        module_id = GetModuleId(build_id)
+        for name in {soname, os.path.basename(binary)} - {None}:
+            symbol_path = os.path.join(symbol_dir, name, module_id, name + '.sym')
+            if os.path.exists(symbol_path):
+                log.append(f'up to date: {symbol_path}')
+                return log, meta
 
     # dump_syms will fail if we pass a debug directory but the debug file isn't found in it.
-    dbg_file = GetDebugFile(binary)
-    if dbg_file is not None and os.path.exists(dbg_file):
-        print(f'debug_file: {dbg_file}')
+    # Look for it on every run rather than caching it, as it may have been installed since.
+    dbg_file = FindDebugFile(binary, build_id, debuglink)
+    if dbg_file is not None:
+        log.append(f'debug_file: {dbg_file}')
         dump_cmd += [os.path.dirname(dbg_file)]
 
-    syms = GetCommandOutput(dump_cmd)
-    if syms is None:
-        return
-    module_line = re.match('^MODULE [^ ]+ [^ ]+ ([0-9A-F]+) (.*)\n', syms)
-    output_path = os.path.join(symbol_dir, module_line.group(2), module_line.group(1))
+    # Ask dump_syms for just the MODULE line to know where the symbols go, then
+    # have it write them straight into the output file. The symbols can be
+    # hundreds of MB for large libraries and never pass through Python this way.
+    header = GetCommandOutput(['dump_syms', '-i', binary])
+    module_line = MODULE_RE.match(header) if header is not None else None
+    if module_line is None:
+        return log, meta
+    module_id = module_line.group(1).decode('utf-8')
+    module_name = module_line.group(2).decode('utf-8')
+    output_path = os.path.join(symbol_dir, module_name, module_id)
     os.makedirs(output_path, exist_ok=True)
-    symbol_file = module_line.group(2) + ".sym"
-    with open(os.path.join(output_path, symbol_file), 'w', encoding='utf-8') as f:
-        f.write(syms)
+    symbol_path = os.path.join(output_path, module_name + ".sym")
+    # Write to a temporary file and only move it into place once dump_syms
+    # succeeded, so an interrupted run can't leave a truncated file behind that
+    # later runs would consider up to date.
+    tmp_path = f'{symbol_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f, tempfile.TemporaryFile() as err:
+            out = subprocess.run(dump_cmd, stdout=f, stderr=err, check=False)
+            if out.returncode != 0:
+                err.seek(0)
+                stderr = err.read().decode('utf-8', errors='replace')
+                print(f'{dump_cmd[0]}: returncode: {out.returncode} stderr: {stderr}', file=sys.stderr)
+        if out.returncode == 0:
+            os.replace(tmp_path, symbol_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return log, meta
+
+def GenerateSymbolsStar(work):
+    """Calls GenerateSymbols with the (symbol_dir, binary, meta) tuple work and
+    returns the binary along with its results, for use with Pool.imap_unordered.
+    """
+    return work[1], GenerateSymbols(*work)
 
 def main():
     if not sys.platform.startswith('linux'):
@@ -88,24 +342,89 @@ def main():
                         help='The directory where to write the symbols file.')
     parser.add_argument('-c', '--clear', default=False, action='store_true',
                         help='Clear the symbols directory before writing new symbols.')
+    parser.add_argument('--no-cache', default=False, action='store_true',
+                        help=f'Don\'t use or update the results of previous runs in {CACHE_FILE}.')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of binaries to process in parallel. Defaults to the number '
+                             'of CPUs available to this process.')
     parser.add_argument('binaries', nargs='+', help='list of binaries to process')
     args = parser.parse_args()
 
-    if args.clear:
-        shutil.rmtree(args.symbols_dir, ignore_errors=True)
+    # Move the old symbols out of the way, they are deleted in the background
+    # while the new ones are generated.
+    old_symbols_dir = None
+    if args.clear and os.path.exists(args.symbols_dir):
+        old_symbols_dir = f'{os.path.normpath(args.symbols_dir)}.old.{os.getpid()}'
+        try:
+            os.rename(args.symbols_dir, old_symbols_dir)
+        except OSError:
+            shutil.rmtree(args.symbols_dir, ignore_errors=True)
+            old_symbols_dir = None
+
+    cache = {} if args.no_cache else LoadCache(CACHE_FILE)
 
-    # Build the transitive closure of all dependencies.
-    binaries = set(args.binaries)
-    queue = args.binaries
+    # Build the transitive closure of all dependencies, one level at a time so
+    # that each level only needs a single ldd invocation. Paths are resolved so
+    # that a library reached through several symlinks is only processed once.
+    # The cache keeps the paths as ldd printed them, along with their stamps,
+    # and they are resolved again on every run.
+    binaries = {os.path.realpath(b) for b in args.binaries}
+    queue = deque(binaries)
     while queue:
-        deps = GetSharedLibraryDependencies(queue.pop(0))
-        new_deps = set(deps) - binaries
+        level = list(queue)
+        queue.clear()
+        entries = {b: GetCacheEntry(cache, b) for b in level}
+        level_deps = {b: entries[b]['deps'] for b in level if 'deps' in entries[b]}
+        missing = [b for b in level if b not in level_deps]
+        if missing:
+            deps, not_found = GetSharedLibraryDependencies(missing)
+            for binary in missing:
+                level_deps[binary] = [[d, GetFileStamp(d)] for d in deps[binary]]
+                # Don't cache an incomplete result, so the libraries ldd couldn't
+                # find are picked up once they are installed.
+                if binary in not_found:
+                    print(f'{binary}: some shared library dependencies were not found', file=sys.stderr)
+                else:
+                    entries[binary]['deps'] = level_deps[binary]
+        new_deps = set()
+        for binary_deps in level_deps.values():
+            new_deps |= {os.path.realpath(d) for d, _ in binary_deps} - binaries
         binaries |= new_deps
-        queue.extend(list(new_deps))
+        queue.extend(new_deps)
+
+    # Each binary is independent, so dump them in parallel. Create the top
+    # level directory up front so the workers don't race on it.
+    os.makedirs(args.symbols_dir, exist_ok=True)
+    # Start with the largest binaries, which take the longest to dump, so that
+    # a big library picked up last doesn't leave the other workers idle. The
+    # sizes were already recorded in the cache entries.
+    binaries = sorted(binaries, key=lambda b: (cache[b]['stamp'] or [0])[-1], reverse=True)
+    work = []
     for binary in binaries:
-        print(f'binary: {binary}')
-        GenerateSymbols(args.symbols_dir, binary)
-        print('')
+        meta = cache[binary].get('meta')
+        work.append((args.symbols_dir, binary, tuple(meta) if meta is not None else None))
+    # os.cpu_count() reports every CPU of the machine, but a container may only
+    # be allowed to run on some of them.
+    jobs = args.jobs
+    if jobs is None:
+        jobs = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    jobs = max(1, min(jobs, len(binaries)))
+    clear_thread = None
+    with multiprocessing.Pool(processes=jobs) as pool:
+        # Only start the deletion thread once the workers have been forked, as
+        # forking a process that is running other threads isn't safe.
+        if old_symbols_dir is not None:
+            clear_thread = threading.Thread(target=shutil.rmtree, args=(old_symbols_dir, True))
+            clear_thread.start()
+        for binary, (log, meta) in pool.imap_unordered(GenerateSymbolsStar, work, chunksize=1):
+            cache[binary]['meta'] = meta
+            print('\n'.join(log))
+            print('')
+
+    if not args.no_cache:
+        SaveCache(CACHE_FILE, cache)
+    if clear_thread is not None:
+        clear_thread.join()
     return 0
 
 if '__main__' == __name__: